@@ -0,0 +1,550 @@
+"""Càrrega de dades i agregats del dashboard, compartits per app.py i api.py."""
+import os
+import collections
+import streamlit as st
+import pandas as pd
+import numpy as np
+from scipy import sparse, special
+
+from reference import WORDCLOUD_STOPWORDS
+
+# --- Carrega el dataset ---
+DATA_PATH = "final.csv"
+# Entrades màximes de la cache de cada agregat: les claus inclouen els filtres (i els paràmetres de
+# l'API), així que sense límit un servidor de llarga durada acumularia un resultat per combinació
+CACHE_MAX_ENTRIES = 256
+# Les càrregues que només depenen de la versió de les dades guarden només l'última: si no, cada
+# canvi de final.csv deixaria una còpia més del dataset en memòria als processos de llarga durada
+VERSION_CACHE_ENTRIES = 1
+
+def data_version():
+    """Identificador de la versió de les dades: canvia quan es modifica final.csv."""
+    stat = os.stat(DATA_PATH)
+    return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+def load_data():
+    """Llegeix i prepara final.csv; sense cache pròpia, només el crida date_index, que en guarda el resultat."""
+    df = pd.read_csv(DATA_PATH, parse_dates=["date"])
+    # Ordenat per data: els rangs de dates es resolen amb cerca binària (vegeu select_positions)
+    df = df.sort_values("date", kind="stable").reset_index(drop=True)
+    df["month"] = df["date"].dt.to_period("M").astype(str)
+    df["year"] = df["date"].dt.year
+    # Mes com a número (1-12)
+    df["month_num"] = df["date"].dt.month
+    return df
+
+@st.cache_resource(max_entries=VERSION_CACHE_ENTRIES)
+def date_index(version):
+    """Taula ordenada per data, les dates com a array i les posicions de cada estat.
+
+    És un recurs compartit (st.cache_resource) perquè filtrar no hagi de copiar tota
+    la taula a cada crida, com passaria amb st.cache_data; no s'ha de modificar.
+    """
+    df = load_data()
+    return df, df["date"].to_numpy(), df.groupby("state").indices
+
+def select_positions(version, year="Tots", state="Tots", start=None, end=None, states=()):
+    """Posicions de les files dins del rang de dates [start, end] i dels estats triats.
+
+    L'any i l'estat de cada secció s'intersequen amb el filtre global (rang de dates i
+    estats; buit vol dir tots). El rang es resol amb searchsorted sobre les dates
+    ordenades i els estats amb les seves posicions, així que el cost depèn de la mida
+    del resultat i no de la del dataset. Retorna un slice si no cal filtrar per estat.
+    """
+    df, dates, positions_by_state = date_index(version)
+    lo = pd.Timestamp(start) if start is not None else None
+    hi = pd.Timestamp(end) if end is not None else None
+    if year != "Tots":
+        first_day, last_day = pd.Timestamp(int(year), 1, 1), pd.Timestamp(int(year), 12, 31)
+        lo = first_day if lo is None else max(lo, first_day)
+        hi = last_day if hi is None else min(hi, last_day)
+    lo_pos = 0 if lo is None else int(np.searchsorted(dates, lo.to_datetime64(), side="left"))
+    # end inclusiu: totes les files d'abans del dia següent
+    hi_pos = len(dates) if hi is None else int(np.searchsorted(dates, (hi + pd.Timedelta(days=1)).to_datetime64(), side="left"))
+    hi_pos = max(lo_pos, hi_pos)
+
+    if state != "Tots":
+        states = [state] if not states or state in states else []
+    elif not states:
+        return slice(lo_pos, hi_pos)
+    parts = []
+    for name in states:
+        positions = positions_by_state.get(name, np.empty(0, dtype=np.intp))
+        parts.append(positions[np.searchsorted(positions, lo_pos):np.searchsorted(positions, hi_pos)])
+    return np.sort(np.concatenate(parts)) if parts else np.empty(0, dtype=np.intp)
+
+def filter_rows(version, year="Tots", state="Tots", start=None, end=None, states=()):
+    """Files del dataset per any i estat ("Tots" vol dir sense filtre) dins del filtre global."""
+    df = date_index(version)[0]
+    return df.iloc[select_positions(version, year, state, start, end, states)]
+
+def date_limits(version):
+    """Primera i última data del dataset."""
+    dates = date_index(version)[1]
+    return pd.Timestamp(dates[0]).date(), pd.Timestamp(dates[-1]).date()
+
+MONTHS = pd.Index(range(1, 13), name="month_num")
+
+@st.cache_data(max_entries=VERSION_CACHE_ENTRIES)
+def filter_options(version):
+    """Opcions dels selectbox d'any i d'estat, amb "Tots" al davant."""
+    df = date_index(version)[0]
+    anys_options = ["Tots"] + [str(a) for a in sorted(df["year"].unique())]
+    estats_options = ["Tots"] + list(df["state"].unique())
+    return anys_options, estats_options
+
+# --- Agregats per secció ---
+@st.cache_data(max_entries=CACHE_MAX_ENTRIES)
+def monthly_incidents(version, start=None, end=None, states=()):
+    """Incidents per mes (AAAA-MM) de tota la sèrie."""
+    df = filter_rows(version, start=start, end=end, states=states)
+    return df.groupby("month")["incident_id"].count().reset_index(name="incidents")
+
+@st.cache_data(max_entries=CACHE_MAX_ENTRIES)
+def incidents_by_year_month(version, state="Tots", start=None, end=None, states=()):
+    """Incidents per any i mes, amb tots els mesos presents per a cada any."""
+    df = filter_rows(version, state=state, start=start, end=end, states=states)
+    counts = df.groupby(["year", "month_num"])["incident_id"].count()
+    all_years = counts.index.get_level_values("year").unique()
+    full_index = pd.MultiIndex.from_product([all_years, range(1, 13)], names=["year", "month_num"])
+    return counts.reindex(full_index, fill_value=0).reset_index(name="incidents")
+
+@st.cache_data(max_entries=CACHE_MAX_ENTRIES)
+def incidents_and_checks_by_month(version, year="Tots", state="Tots", start=None, end=None, states=()):
+    """Incidents i comprovacions d'antecedents d'armes per mes de l'any."""
+    df = filter_rows(version, year, state, start, end, states)
+    checks = df[["state", "year", "month_num"]].assign(
+        background_checks=pd.to_numeric(df["state_month_firearm_background_checks"], errors="coerce")
+    )
+    # Drop duplicates so each state/month/year is only counted once
+    checks_unique = checks.drop_duplicates(subset=["state", "year", "month_num"])
+    return pd.DataFrame({
+        "incidents": df.groupby("month_num")["incident_id"].count().reindex(MONTHS, fill_value=0),
+        "background_checks": checks_unique.groupby("month_num")["background_checks"].sum().reindex(MONTHS, fill_value=0),
+    }).reset_index()
+
+@st.cache_data(max_entries=CACHE_MAX_ENTRIES)
+def incidents_and_unemployment_by_month(version, year="Tots", state="Tots", start=None, end=None, states=()):
+    """Incidents i taxa d'atur mitjana (%) per mes de l'any."""
+    df = filter_rows(version, year, state, start, end, states)
+    unemp = df[["state", "year", "month_num"]].assign(
+        unemployment_rate=100 - pd.to_numeric(df["state_month_employment_rate"], errors="coerce")
+    )
+    # Deduplicate so each state/month/year is only counted once
+    unemp_unique = unemp.drop_duplicates(subset=["state", "year", "month_num"])
+    return pd.DataFrame({
+        "incidents": df.groupby("month_num")["incident_id"].count().reindex(MONTHS, fill_value=0),
+        "unemployment_rate": unemp_unique.groupby("month_num")["unemployment_rate"].mean().reindex(MONTHS),
+    }).reset_index()
+
+# Comptes de la taula de taxes per estat i any (columna -> etiqueta); cadascun té també la seva taxa
+# `<columna>_per_100k`, així que afegir una mètrica al mapa és afegir-hi una entrada i una columna
+RATE_COUNTS = {
+    "incidents": "Incidents",
+    "killed": "Víctimes mortals",
+    "injured": "Ferits",
+    "police_murders": "Víctimes mortals per la policia",
+    "background_checks": "Comprovacions d'antecedents d'armes",
+}
+STATE_METRICS = [metric for count in RATE_COUNTS for metric in (count, f"{count}_per_100k")]
+
+def add_rates(table):
+    """`table` amb la taxa anual per 100.000 habitants de cada compte de RATE_COUNTS."""
+    return table.assign(**{f"{count}_per_100k": 1e5 * table[count] / table["person_years"] for count in RATE_COUNTS})
+
+def year_coverage(years, start, end):
+    """Fracció de cada any dins del rang de dates [start, end] (inclosos)."""
+    years = np.asarray(years, dtype=np.int64)
+    year_start = (years - 1970).astype("datetime64[Y]").astype("datetime64[D]")
+    year_end = (years - 1969).astype("datetime64[Y]").astype("datetime64[D]")
+    lo = np.maximum(year_start, np.datetime64(start, "D"))
+    hi = np.minimum(year_end, np.datetime64(end, "D") + 1)
+    return np.clip((hi - lo).astype(np.int64), 0, None) / (year_end - year_start).astype(np.int64)
+
+@st.cache_data(max_entries=CACHE_MAX_ENTRIES)
+def state_year_rates(version, start=None, end=None, states=()):
+    """Taula estat x any amb els comptes de RATE_COUNTS, la població i les taxes anuals per 100.000 habitants.
+
+    Sense filtre global es calcula un sol cop per versió de les dades i el mapa només en
+    consulta columnes. Els comptes són els del rang de dates, així que la població de cada any
+    es pondera per la part de l'any que cobreixen el rang i les dades (`person_years`).
+    """
+    df = filter_rows(version, start=start, end=end, states=states)
+    table = df.groupby(["state", "year"]).agg(
+        incidents=("incident_id", "count"),
+        killed=("n_killed", "sum"),
+        injured=("n_injured", "sum"),
+        population=("state_year_population", "first"),
+    )
+    # Els indicadors mensuals de l'estat es repeteixen a cada incident: un cop per mes
+    monthly = df.drop_duplicates(subset=["state", "year", "month_num"]).assign(
+        police_murders=lambda d: pd.to_numeric(d["state_month_total_police_murders"], errors="coerce"),
+        background_checks=lambda d: pd.to_numeric(d["state_month_firearm_background_checks"], errors="coerce"),
+    )
+    table = table.join(monthly.groupby(["state", "year"])[["police_murders", "background_checks"]].sum())
+    table["population"] = pd.to_numeric(table["population"], errors="coerce")
+    min_date, max_date = date_limits(version)
+    coverage = year_coverage(
+        table.index.get_level_values("year"),
+        max(start, min_date) if start is not None else min_date,
+        min(end, max_date) if end is not None else max_date,
+    )
+    table["person_years"] = table["population"] * coverage
+    return add_rates(table[list(RATE_COUNTS) + ["population", "person_years"]]).reset_index()
+
+def roll_up_rates(table):
+    """Agrega la taula de taxes per estat sobre diversos anys.
+
+    Els comptes i les poblacions per la part de l'any coberta se sumen, així que cada taxa és
+    la mitjana anual ponderada per la població (dels anys amb població).
+    """
+    known = table[table["person_years"].notna()]
+    rates = add_rates(known.groupby("state")[list(RATE_COUNTS) + ["person_years"]].sum())
+    totals = table.groupby("state")[list(RATE_COUNTS)].sum()
+    return totals.join(rates.drop(columns=list(RATE_COUNTS))).reset_index()
+
+@st.cache_data(max_entries=VERSION_CACHE_ENTRIES)
+def election_2020(version):
+    """Vots de 2020 per estat i guanyador (D o R)."""
+    df = date_index(version)[0]
+    votes_2020 = df.drop_duplicates(subset=["state"])[["state", "state_votes_democrats_2020", "state_votes_republicans_2020"]]
+    democrats = pd.to_numeric(votes_2020["state_votes_democrats_2020"], errors="coerce")
+    republicans = pd.to_numeric(votes_2020["state_votes_republicans_2020"], errors="coerce")
+    return votes_2020.assign(winner_2020=np.where(democrats >= republicans, "D", "R"))
+
+@st.cache_data(max_entries=CACHE_MAX_ENTRIES)
+def state_aggregates(version, year="Tots", start=None, end=None, states=()):
+    """Totes les mètriques del mapa per estat (STATE_METRICS) amb el guanyador de les eleccions de 2020.
+
+    No depèn de la mètrica triada: canviar-la és només escollir una columna del resultat.
+    """
+    table = state_year_rates(version, start, end, states)
+    if year != "Tots":
+        table = table[table["year"] == int(year)]
+    incidents_by_state = roll_up_rates(table)[["state"] + STATE_METRICS]
+    return incidents_by_state.merge(election_2020(version), on="state", how="left")
+
+@st.cache_data(max_entries=CACHE_MAX_ENTRIES)
+def top_cities(version, year="Tots", state="Tots", n=10, start=None, end=None, states=()):
+    """Ciutats o comtats amb més incidents."""
+    df = filter_rows(version, year, state, start, end, states)
+    return df["city_or_county"].value_counts().head(n).rename_axis("city_or_county").reset_index(name="incidents")
+
+@st.cache_data(max_entries=CACHE_MAX_ENTRIES)
+def participants_by_age_gender(version, participant_type="Victim", year="Tots", state="Tots", start=None, end=None, states=()):
+    """Participants d'un tipus per grup d'edat (files) i gènere (columnes)."""
+    df = filter_rows(version, year, state, start, end, states)
+
+    # Parse participant_age_group and participant_gender for selected type
+    age_groups = []
+    genders = []
+    for _, row in df.iterrows():
+        if pd.isna(row["participant_type"]) or pd.isna(row["participant_age_group"]) or pd.isna(row["participant_gender"]):
+            continue
+        types = str(row["participant_type"]).split("||")
+        age_groups_raw = str(row["participant_age_group"]).split("||")
+        genders_raw = str(row["participant_gender"]).split("||")
+        for i, t in enumerate(types):
+            if participant_type in t:
+                # Find matching index for age group and gender
+                age_group = None
+                gender = None
+                # Find age group for this index
+                for ag in age_groups_raw:
+                    if ag.startswith(f"{i}::"):
+                        age_group = ag.split("::", 1)[-1]
+                        break
+                # Find gender for this index
+                for g in genders_raw:
+                    if g.startswith(f"{i}::"):
+                        gender = g.split("::", 1)[-1]
+                        break
+                if age_group and gender:
+                    age_groups.append(age_group)
+                    genders.append(gender)
+
+    plot_df = pd.DataFrame({
+        "age_group": age_groups,
+        "gender": genders
+    }).dropna()
+    if plot_df.empty:
+        return pd.DataFrame(index=pd.Index([], name="age_group"))
+
+    # Get all unique age groups in sorted order (Child 0-11, Teen 12-17, Adult 18+)
+    age_group_order = ["Child 0-11", "Teen 12-17", "Adult 18+", "+65"]
+    all_age_groups = sorted(plot_df["age_group"].unique(), key=lambda x: age_group_order.index(x) if x in age_group_order else x)
+
+    # Count incidents by age group and gender, ensure all bins present
+    return plot_df.groupby(["age_group", "gender"]).size().unstack(fill_value=0).reindex(all_age_groups, fill_value=0)
+
+@st.cache_data(max_entries=CACHE_MAX_ENTRIES)
+def police_victims_by_gender_month(version, year="Tots", state="Tots", start=None, end=None, states=()):
+    """Víctimes mortals per la policia per mes de l'any i gènere."""
+    df = filter_rows(version, year, state, start, end, states)
+    # Deduplicate by state/year/month_num to avoid double counting
+    police_unique = df.drop_duplicates(subset=["state", "year", "month_num"])
+    grouped = pd.DataFrame({
+        "male": pd.to_numeric(police_unique["state_month_police_murders_male_victims"], errors="coerce").fillna(0),
+        "female": pd.to_numeric(police_unique["state_month_police_murders_female_victims"], errors="coerce").fillna(0),
+    }).groupby(police_unique["month_num"]).sum()
+    return grouped.reindex(MONTHS, fill_value=0).reset_index()
+
+@st.cache_data(max_entries=CACHE_MAX_ENTRIES)
+def top_weapons(version, year="Tots", state="Tots", n=3, start=None, end=None, states=()):
+    """Armes més utilitzades (gun_type), comptant Handgun i 9mm com una sola categoria."""
+    df = filter_rows(version, year, state, start, end, states)
+
+    # Parse gun_type (index::value||index::value...)
+    weapon_counts = {}
+    for _, row in df.iterrows():
+        if pd.isna(row["gun_type"]):
+            continue
+        gun_types = str(row["gun_type"]).split("||")
+        for gt in gun_types:
+            if "::" in gt:
+                weapon = gt.split("::", 1)[-1]
+                if weapon and weapon.strip().lower() != "unknown":
+                    weapon_norm = weapon.strip().lower()
+                    if weapon_norm in ["handgun", "9mm"]:
+                        weapon = "Handgun/9mm"
+                    weapon_counts[weapon] = weapon_counts.get(weapon, 0) + 1
+
+    top = collections.Counter(weapon_counts).most_common(n)
+    return pd.DataFrame(top, columns=["weapon", "incidents"])
+
+@st.cache_data(max_entries=CACHE_MAX_ENTRIES)
+def stolen_vs_legal(version, year="Tots", state="Tots", start=None, end=None, states=()):
+    """Incidents amb alguna arma robada i amb alguna arma legal."""
+    df = filter_rows(version, year, state, start, end, states)
+
+    stolen_count = 0
+    not_stolen_count = 0
+    for _, row in df.iterrows():
+        if pd.isna(row["gun_stolen"]):
+            continue
+        gun_stolen_types = str(row["gun_stolen"]).split("||")
+        has_stolen = any(gt.split("::", 1)[-1].strip().lower() == "stolen" for gt in gun_stolen_types if "::" in gt)
+        has_not_stolen = any(gt.split("::", 1)[-1].strip().lower() == "not-stolen" for gt in gun_stolen_types if "::" in gt)
+        if has_stolen:
+            stolen_count += 1
+        if has_not_stolen:
+            not_stolen_count += 1
+
+    return pd.DataFrame({"gun": ["stolen", "not_stolen"], "incidents": [stolen_count, not_stolen_count]})
+
+@st.cache_data(max_entries=CACHE_MAX_ENTRIES)
+def victims_by_weapon_count(version, year="Tots", state="Tots", start=None, end=None, states=()):
+    """Total de víctimes mortals segons el nombre d'armes diferents de l'incident (1-6 i 6+)."""
+    df = filter_rows(version, year, state, start, end, states)
+
+    line_data = []
+    for _, row in df.iterrows():
+        if pd.isna(row["gun_type"]) or pd.isna(row["n_killed"]):
+            continue
+        gun_types = [gt for gt in str(row["gun_type"]).split("||") if "::" in gt and gt.split("::", 1)[-1].strip().lower() != "unknown" and gt.split("::", 1)[-1].strip()]
+        num_weapons = len(set(["Handgun/9mm" if gt.split("::", 1)[-1].strip().lower() in ["handgun", "9mm"] else gt.split("::", 1)[-1].strip() for gt in gun_types]))
+        try:
+            num_victims = int(row["n_killed"])
+        except (TypeError, ValueError):
+            continue
+        if num_weapons > 6:
+            num_weapons = '6+'
+        line_data.append((num_weapons, num_victims))
+    if not line_data:
+        return pd.DataFrame(columns=["num_weapons", "num_victims"])
+
+    line_df = pd.DataFrame(line_data, columns=["num_weapons", "num_victims"])
+    # Ensure '6+' is last and all 1-6 are present
+    order = [1, 2, 3, 4, 5, 6, '6+']
+    return line_df.groupby("num_weapons")["num_victims"].sum().reindex(order, fill_value=0).reset_index()
+
+# --- Matriu dispersa de característiques d'incident ---
+@st.cache_resource(max_entries=VERSION_CACHE_ENTRIES)
+def load_characteristics(version):
+    """Matriu CSR booleana incidents x etiquetes d'`incident_characteristics` i el vocabulari d'etiquetes.
+
+    Les files segueixen l'ordre de date_index, així que es poden seleccionar amb select_positions.
+    Com date_index, és un recurs compartit que es construeix un sol cop; no s'ha de modificar.
+    """
+    df = date_index(version)[0]
+    tags = df["incident_characteristics"].str.split(r"\|{1,2}").explode().str.strip()
+    tags = tags[tags.notna() & (tags != "")]
+    codes, vocab = pd.factorize(tags, sort=True)
+    # Les files repetides (mateixa etiqueta dues vegades a un incident) se sumen i es redueixen a True
+    matrix = sparse.csr_matrix(
+        (np.ones(len(codes), dtype=np.int32), (tags.index.to_numpy(), codes)),
+        shape=(len(df), len(vocab)),
+    ).astype(bool)
+    return matrix, np.asarray(vocab, dtype=object)
+
+def group_indicator(codes, n_groups):
+    """Matriu CSR grups x incidents amb un 1 a la columna de cada incident del seu grup."""
+    cols = np.flatnonzero(codes >= 0)  # pd.factorize marca els valors nuls amb -1
+    return sparse.csr_matrix(
+        (np.ones(len(cols), dtype=np.int32), (codes[cols], cols)), shape=(n_groups, len(codes))
+    )
+
+@st.cache_data(max_entries=CACHE_MAX_ENTRIES)
+def characteristic_pairs(version, year="Tots", state="Tots", top_n=20, start=None, end=None, states=()):
+    """Parelles de característiques que apareixen juntes més sovint, via el producte X^T X."""
+    matrix, vocab = load_characteristics(version)
+    x = matrix[select_positions(version, year, state, start, end, states)].astype(np.int32)
+    support = np.asarray(x.sum(axis=0)).ravel()
+    cooc = sparse.triu(x.T @ x, k=1).tocoo()
+    pairs = pd.DataFrame({
+        "Característica A": vocab[cooc.row],
+        "Característica B": vocab[cooc.col],
+        "Incidents": cooc.data,
+    })
+    # Jaccard: incidents amb totes dues / incidents amb alguna de les dues
+    pairs["Jaccard"] = cooc.data / (support[cooc.row] + support[cooc.col] - cooc.data)
+    return pairs.nlargest(top_n, "Incidents").reset_index(drop=True)
+
+@st.cache_data(max_entries=CACHE_MAX_ENTRIES)
+def characteristic_counts_by(version, group_col, start=None, end=None, states=()):
+    """Incidents per grup (any o estat) i característica, via el producte G X."""
+    if group_col not in ("year", "state"):
+        raise ValueError(f"Agrupació desconeguda: {group_col}")
+    positions = select_positions(version, start=start, end=end, states=states)
+    values = date_index(version)[0][group_col].iloc[positions]
+    matrix, vocab = load_characteristics(version)
+    codes, groups = pd.factorize(values, sort=True)
+    counts = group_indicator(codes, len(groups)) @ matrix[positions].astype(np.int32)
+    return pd.DataFrame(counts.toarray(), index=groups, columns=vocab)
+
+# --- Correlacions per estat ---
+CORRELATION_INDICATORS = {
+    "Taxa d'atur (%)": "state_month_unemployment_rate",
+    "Comprovacions antecedents d'armes": "state_month_firearm_background_checks",
+}
+# Mesos superposats mínims per donar una correlació (en absolut i com a fracció dels mesos del rang):
+# amb pocs punts |r| surt alt per atzar
+MIN_CORRELATION_MONTHS = 12
+MIN_CORRELATION_COVERAGE = 0.5
+
+@st.cache_data(max_entries=CACHE_MAX_ENTRIES)
+def state_month_matrices(version, start=None, end=None, states=()):
+    """Matrius estat x mes d'incidents i de cada indicador de CORRELATION_INDICATORS."""
+    df = filter_rows(version, start=start, end=end, states=states)
+    if df.empty:
+        months = []
+    else:
+        months = pd.period_range(df["date"].iloc[0], df["date"].iloc[-1], freq="M").astype(str)
+    incidents = (
+        df.groupby(["state", "month"])["incident_id"].count().unstack(fill_value=0)
+        .reindex(columns=months, fill_value=0)
+    )
+    # Els indicadors són mensuals per estat: cada estat/mes només es compta una vegada
+    unique = df.drop_duplicates(subset=["state", "month"]).set_index(["state", "month"])
+    indicators = pd.DataFrame({
+        "state_month_unemployment_rate": 100 - pd.to_numeric(unique["state_month_employment_rate"], errors="coerce"),
+        "state_month_firearm_background_checks": pd.to_numeric(unique["state_month_firearm_background_checks"], errors="coerce"),
+    })
+    series = {"incidents": incidents.to_numpy(dtype=float)}
+    for col in indicators.columns:
+        series[col] = indicators[col].unstack().reindex(index=incidents.index, columns=months).to_numpy(dtype=float)
+    return incidents.index.to_numpy(), np.asarray(months), series
+
+def overlap_months(x, y):
+    """Mesos on x i y tenen valor, sobre l'últim eix."""
+    return (~(np.isnan(x) | np.isnan(y))).sum(axis=-1)
+
+def batched_pearson(x, y, min_months=MIN_CORRELATION_MONTHS):
+    """Correlació de Pearson sobre l'últim eix, per a totes les files alhora, ignorant els mesos amb NaN.
+
+    És NaN si x i y comparteixen menys de `min_months` mesos vàlids.
+    """
+    valid = ~(np.isnan(x) | np.isnan(y))
+    n = overlap_months(x, y)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_x = np.where(valid, x, 0).sum(axis=-1, keepdims=True) / n[..., None]
+        mean_y = np.where(valid, y, 0).sum(axis=-1, keepdims=True) / n[..., None]
+        dx = np.where(valid, x - mean_x, 0)
+        dy = np.where(valid, y - mean_y, 0)
+        r = (dx * dy).sum(axis=-1) / np.sqrt((dx ** 2).sum(axis=-1) * (dy ** 2).sum(axis=-1))
+    return np.where(n >= max(min_months, 3), r, np.nan)
+
+def batched_spearman(x, y, min_months=MIN_CORRELATION_MONTHS):
+    """Correlació de Spearman fila a fila: Pearson sobre els rangs dels mesos vàlids per a totes dues sèries."""
+    valid = ~(np.isnan(x) | np.isnan(y))
+    rank_x = pd.DataFrame(np.where(valid, x, np.nan)).rank(axis=1).to_numpy()
+    rank_y = pd.DataFrame(np.where(valid, y, np.nan)).rank(axis=1).to_numpy()
+    return batched_pearson(rank_x, rank_y, min_months)
+
+def pearson_pvalue(r, n):
+    """p-valor bilateral de la correlació r amb n punts (test t amb n - 2 graus de llibertat)."""
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = np.abs(r) * np.sqrt((n - 2) / (1 - r ** 2))
+    return 2 * special.stdtr(n - 2, -t)
+
+def lagged_correlations(x, y, max_lag, min_months=MIN_CORRELATION_MONTHS):
+    """Correlació creuada estat x retard i mesos superposats a cada retard.
+
+    Al retard k es compara x[t] amb y[t-k] (k > 0: l'indicador s'avança).
+    """
+    lags = np.arange(-max_lag, max_lag + 1)
+    padded = np.pad(y, ((0, 0), (max_lag, max_lag)), constant_values=np.nan)
+    # windows[:, j, t] = y[t + j - max_lag], és a dir el retard k = max_lag - j
+    windows = np.lib.stride_tricks.sliding_window_view(padded, x.shape[1], axis=1)[:, ::-1, :]
+    return lags, batched_pearson(x[:, None, :], windows, min_months), overlap_months(x[:, None, :], windows)
+
+@st.cache_data(max_entries=CACHE_MAX_ENTRIES)
+def state_correlations(version, indicator, max_lag=12, start=None, end=None, states=()):
+    """Taula de correlacions per estat i matriu estat x retard entre incidents mensuals i l'indicador.
+
+    L'indicador només es coneix els mesos amb algun incident a l'estat, així que una correlació
+    (també a cada retard) necessita com a mínim MIN_CORRELATION_MONTHS mesos superposats i
+    MIN_CORRELATION_COVERAGE dels mesos del rang. El retard es limita a un terç del rang, el
+    retard òptim és el de menor p-valor (buit si cap no és vàlid) i la taula s'ordena per p-valor.
+    """
+    states, months, series = state_month_matrices(version, start, end, states)
+    x, y = series["incidents"], series[indicator]
+    if x.size == 0:
+        x = y = np.empty((len(states), 1))  # sense mesos: correlacions NaN
+    min_months = max(MIN_CORRELATION_MONTHS, int(np.ceil(MIN_CORRELATION_COVERAGE * len(months))))
+    lags, xcorr, xcorr_months = lagged_correlations(x, y, min(max_lag, len(months) // 3), min_months)
+    has_lag = ~np.isnan(xcorr).all(axis=1)
+    best = np.nan_to_num(pearson_pvalue(xcorr, xcorr_months), nan=np.inf).argmin(axis=1)
+    pearson, n = batched_pearson(x, y, min_months), overlap_months(x, y)
+    table = pd.DataFrame({
+        "Estat": states,
+        "Mesos amb dades": n,
+        "Pearson": pearson,
+        "p-valor": pearson_pvalue(pearson, n),
+        "Spearman": batched_spearman(x, y, min_months),
+        "Retard òptim (mesos)": pd.Series(lags[best], dtype="Int64").where(has_lag),
+        "Correlació al retard òptim": np.where(has_lag, xcorr[np.arange(len(states)), best], np.nan),
+    })
+    table = table.sort_values("p-valor", na_position="last", kind="stable").reset_index(drop=True)
+    return table, pd.DataFrame(xcorr, index=states, columns=lags)
+
+
+# --- Núvol de paraules ---
+@st.cache_data(max_entries=CACHE_MAX_ENTRIES)
+def wordcloud_image(version, start=None, end=None, states=()):
+    """Núvol de paraules de notes i característiques d'incidents, com a imatge RGB (None si no hi ha text)."""
+    # wordcloud només s'importa quan cal generar el núvol (un cop per versió de les dades i filtre)
+    from wordcloud import WordCloud, STOPWORDS
+
+    df = filter_rows(version, start=start, end=end, states=states)
+    # Merge notes and incident_characteristics, handle NaN
+    text_data = (
+        df["notes"].fillna("") + " " + df["incident_characteristics"].fillna("")
+    ).str.cat(sep=" ")
+    if not text_data.strip():
+        return None
+
+    stopwords = set(STOPWORDS)
+    stopwords.update(WORDCLOUD_STOPWORDS)
+
+    try:
+        wordcloud = WordCloud(
+            width=900, height=400,
+            background_color="white",
+            stopwords=stopwords,
+            collocations=False,
+            max_words=150
+        ).generate(text_data)
+    except ValueError:  # només hi havia stopwords
+        return None
+    return wordcloud.to_array()
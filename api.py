@@ -0,0 +1,188 @@
+"""API HTTP de només lectura amb els agregats del dashboard, en JSON o CSV.
+
+S'executa al costat de l'app de Streamlit i reutilitza les mateixes funcions
+cachejades d'aggregates.py:
+
+    streamlit run app.py
+    python api.py --port 8502
+
+    GET /api                                  -> llista de seccions i paràmetres
+    GET /api/<secció>?year=2017&state=Texas   -> JSON (per defecte)
+    GET /api/<secció>?...&format=csv          -> CSV enviat per blocs
+
+Totes les seccions accepten també el filtre global del dashboard:
+start=2015-01-01&end=2016-12-31 (inclosos) i states=Texas,Ohio.
+
+Les respostes porten un ETag derivat de la versió de les dades i dels
+paràmetres, de manera que les peticions repetides amb If-None-Match reben un
+304 sense tornar a calcular res.
+"""
+import argparse
+import hashlib
+import json
+import logging
+
+import pandas as pd
+import tornado.ioloop
+import tornado.web
+
+# Fora de `streamlit run` no hi ha sessió: st.cache_data funciona igualment, però avisa a cada crida
+# (un filtre i no setLevel, perquè Streamlit reinicia el nivell dels seus loggers en llegir la configuració)
+for _name in ("streamlit.runtime.scriptrunner_utils.script_run_context", "streamlit.runtime.caching.cache_data_api"):
+    logging.getLogger(_name).addFilter(lambda record: record.levelno >= logging.ERROR)
+
+import aggregates  # noqa: E402
+
+CSV_CHUNK_ROWS = 10_000
+
+
+def _correlation_table(version, indicator, max_lag, **global_filter):
+    return aggregates.state_correlations(version, indicator, max_lag, **global_filter)[0]
+
+
+def _correlation_lags(version, indicator, max_lag, **global_filter):
+    return aggregates.state_correlations(version, indicator, max_lag, **global_filter)[1]
+
+
+# Secció -> (funció d'agregats, paràmetres amb el seu valor per defecte)
+SECTIONS = {
+    "monthly": (aggregates.monthly_incidents, {}),
+    "year_month": (aggregates.incidents_by_year_month, {"state": "Tots"}),
+    "checks": (aggregates.incidents_and_checks_by_month, {"year": "Tots", "state": "Tots"}),
+    "unemployment": (aggregates.incidents_and_unemployment_by_month, {"year": "Tots", "state": "Tots"}),
+    "correlations": (_correlation_table, {"indicator": "state_month_unemployment_rate", "max_lag": 12}),
+    "correlation_lags": (_correlation_lags, {"indicator": "state_month_unemployment_rate", "max_lag": 12}),
+    "states": (aggregates.state_aggregates, {"year": "Tots"}),
+    "rates": (aggregates.state_year_rates, {}),
+    "cities": (aggregates.top_cities, {"year": "Tots", "state": "Tots", "n": 10}),
+    "participants": (aggregates.participants_by_age_gender, {"participant_type": "Victim", "year": "Tots", "state": "Tots"}),
+    "police": (aggregates.police_victims_by_gender_month, {"year": "Tots", "state": "Tots"}),
+    "weapons": (aggregates.top_weapons, {"year": "Tots", "state": "Tots", "n": 3}),
+    "stolen": (aggregates.stolen_vs_legal, {"year": "Tots", "state": "Tots"}),
+    "weapon_victims": (aggregates.victims_by_weapon_count, {"year": "Tots", "state": "Tots"}),
+    "characteristic_pairs": (aggregates.characteristic_pairs, {"year": "Tots", "state": "Tots", "top_n": 20}),
+    "characteristic_counts": (aggregates.characteristic_counts_by, {"group_col": "year"}),
+}
+
+# Límits (inclosos) dels paràmetres numèrics; max_lag com el slider de l'app
+PARAM_BOUNDS = {"max_lag": (0, 24), "n": (1, 100), "top_n": (1, 100)}
+
+# Filtre global comú a totes les seccions (sense valor = tot el dataset)
+GLOBAL_PARAMS = {"start": None, "end": None, "states": ""}
+
+FORMATS = {
+    "json": "application/json; charset=UTF-8",
+    "csv": "text/csv; charset=UTF-8",
+}
+
+
+class IndexHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write({name: {**params, **GLOBAL_PARAMS} for name, (_, params) in SECTIONS.items()})
+
+
+class SectionHandler(tornado.web.RequestHandler):
+    def initialize(self):
+        self._etag = None
+
+    def compute_etag(self):
+        return self._etag
+
+    def _parse_params(self, defaults):
+        params = {}
+        for name, default in defaults.items():
+            value = self.get_query_argument(name, str(default))
+            if name == "year" and value != "Tots" and not value.isdigit():
+                raise tornado.web.HTTPError(400, reason=f"Any no vàlid: {value}")
+            try:
+                params[name] = type(default)(value)
+            except ValueError:
+                raise tornado.web.HTTPError(400, reason=f"Paràmetre no vàlid: {name}")
+            if name in PARAM_BOUNDS:
+                low, high = PARAM_BOUNDS[name]
+                if not low <= params[name] <= high:
+                    raise tornado.web.HTTPError(400, reason=f"{name} ha d'estar entre {low} i {high}")
+        return params
+
+    def _parse_date(self, name):
+        value = self.get_query_argument(name, None)
+        if not value:
+            return None
+        try:
+            return pd.Timestamp(value).date()
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason=f"Data no vàlida: {value}")
+
+    def _parse_global_filter(self):
+        states = {s.strip() for s in self.get_query_argument("states", "").split(",") if s.strip()}
+        return self._parse_date("start"), self._parse_date("end"), states
+
+    @staticmethod
+    def _normalise_global_filter(version, start, end, states):
+        # Normalitzat com a l'app (sense límit si cobreix tot el dataset, estats ordenats i sense
+        # repetir) perquè les peticions equivalents comparteixin entrada de cache i ETag
+        min_date, max_date = aggregates.date_limits(version)
+        unknown = states.difference(aggregates.filter_options(version)[1][1:])
+        if unknown:
+            raise tornado.web.HTTPError(400, reason=f"Estat desconegut: {', '.join(sorted(unknown))}")
+        return {
+            "start": start if start is not None and start > min_date else None,
+            "end": end if end is not None and end < max_date else None,
+            "states": tuple(sorted(states)),
+        }
+
+    async def get(self, section):
+        if section not in SECTIONS:
+            raise tornado.web.HTTPError(404, reason=f"Secció desconeguda: {section}")
+        func, defaults = SECTIONS[section]
+        params = self._parse_params(defaults)
+        fmt = self.get_query_argument("format", "json")
+        if fmt not in FORMATS:
+            raise tornado.web.HTTPError(400, reason=f"Format no vàlid: {fmt}")
+
+        version = aggregates.data_version()
+        loop = tornado.ioloop.IOLoop.current()
+        # Amb la cache freda (procés nou o final.csv canviat) això carrega el dataset: fora de l'IOLoop,
+        # perquè no bloquegi les altres peticions (ni les revalidacions 304)
+        global_filter = await loop.run_in_executor(
+            None, self._normalise_global_filter, version, *self._parse_global_filter()
+        )
+        key = json.dumps([version, section, params, global_filter, fmt], sort_keys=True, default=str)
+        self._etag = '"%s"' % hashlib.sha1(key.encode()).hexdigest()
+        self.set_etag_header()
+        self.set_header("Cache-Control", "no-cache")
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+
+        try:
+            result = await loop.run_in_executor(None, lambda: func(version, **params, **global_filter))
+        except (KeyError, ValueError) as e:
+            raise tornado.web.HTTPError(400, reason=str(e))
+        if not isinstance(result.index, pd.RangeIndex):
+            result = result.reset_index()
+
+        self.set_header("Content-Type", FORMATS[fmt])
+        if fmt == "json":
+            self.write(result.to_json(orient="records", force_ascii=False, date_format="iso"))
+            return
+        self.set_header("Content-Disposition", f'attachment; filename="{section}.csv"')
+        for start in range(0, max(len(result), 1), CSV_CHUNK_ROWS):
+            chunk = result.iloc[start:start + CSV_CHUNK_ROWS]
+            self.write(chunk.to_csv(index=False, header=start == 0))
+            await self.flush()
+
+
+def make_app():
+    return tornado.web.Application([
+        (r"/api/?", IndexHandler),
+        (r"/api/([a-z_]+)", SectionHandler),
+    ])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8502)
+    args = parser.parse_args()
+    make_app().listen(args.port)
+    tornado.ioloop.IOLoop.current().start()
@@ -0,0 +1,275 @@
+"""Prova de càrrega d'app.py amb sessions concurrents simulades amb AppTest.
+
+Cada sessió és un `streamlit.testing.v1.AppTest` que executa l'script sencer i
+després canvia selectboxes (any, estat, mètrica...) amb un temps de reflexió
+aleatori entre interaccions. AppTest no es pot executar en diversos fils d'un
+mateix procés (crea i destrueix un Runtime global a cada execució), així que
+cada sessió és un procés propi: la latència reflecteix la competència per la
+CPU entre sessions, la memòria es mesura per procés i cada sessió escalfa la
+seva pròpia cache de st.cache_data abans de començar a interactuar.
+
+    python loadtest.py --concurrency 1,2,4,8 --interactions 10 --rows 100000
+
+Per defecte genera un final.csv sintètic en un directori temporal; amb
+--data es pot fer servir un fitxer real.
+"""
+import argparse
+import multiprocessing
+import os
+import queue as queue_module
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+# Selectboxes que canvien les sessions simulades
+WIDGETS = [
+    "heatmap_metric",
+    "heatmap_year",
+    "participant_type_bar",
+    "cities_state",
+    "cities_year",
+    "interactive_year",
+    "interactive_state",
+    "yearly_state",
+    "corr_indicator",
+]
+
+STATES = [
+    "Alabama", "Alaska", "Arizona", "Arkansas", "California", "Colorado", "Connecticut", "Delaware",
+    "District of Columbia", "Florida", "Georgia", "Hawaii", "Idaho", "Illinois", "Indiana", "Iowa",
+    "Kansas", "Kentucky", "Louisiana", "Maine", "Maryland", "Massachusetts", "Michigan", "Minnesota",
+    "Mississippi", "Missouri", "Montana", "Nebraska", "Nevada", "New Hampshire", "New Jersey",
+    "New Mexico", "New York", "North Carolina", "North Dakota", "Ohio", "Oklahoma", "Oregon",
+    "Pennsylvania", "Rhode Island", "South Carolina", "South Dakota", "Tennessee", "Texas", "Utah",
+    "Vermont", "Virginia", "Washington", "West Virginia", "Wisconsin", "Wyoming",
+]
+
+CHARACTERISTICS = [
+    "Shot - Wounded/Injured", "Shot - Dead (murder, accidental, suicide)", "Non-Shooting Incident",
+    "Shots Fired - No Injuries", "Armed robbery with injury/death and/or evidence of DGU found",
+    "Drug involvement", "Gang involvement", "Home Invasion", "Domestic Violence", "Officer Involved Incident",
+    "Possession (gun(s) found during commission of other crimes)", "Suicide^", "Mass Shooting (4+ victims injured or killed excluding the subject/suspect/perpetrator, one location)",
+]
+GUN_TYPES = ["Handgun", "9mm", "Rifle", "Shotgun", "22 LR", "40 SW", "45 Auto", "38 Spl", "Unknown"]
+AGE_GROUPS = ["Child 0-11", "Teen 12-17", "Adult 18+"]
+
+
+def _indexed(values):
+    return "||".join(f"{i}::{v}" for i, v in enumerate(values))
+
+
+def make_synthetic_dataset(path, rows=50_000, seed=0):
+    """Escriu a `path` un final.csv sintètic amb les columnes que fa servir app.py."""
+    rng = np.random.default_rng(seed)
+    dates = pd.Timestamp("2013-01-01") + pd.to_timedelta(rng.integers(0, 6 * 365, rows), unit="D")
+    weights = rng.gamma(1.0, 1.0, len(STATES))
+    states = rng.choice(STATES, rows, p=weights / weights.sum())
+
+    participants = rng.integers(1, 5, rows)
+    n_guns = rng.integers(0, 4, rows)
+    n_chars = rng.integers(0, 5, rows)
+    df = pd.DataFrame({
+        "incident_id": np.arange(rows),
+        "date": dates.strftime("%Y-%m-%d"),
+        "state": states,
+        "city_or_county": [f"City {c}" for c in rng.integers(0, 300, rows)],
+        "n_killed": rng.poisson(0.3, rows),
+        "n_injured": rng.poisson(0.5, rows),
+        "participant_type": [_indexed(rng.choice(["Victim", "Subject-Suspect"], k)) for k in participants],
+        "participant_age_group": [_indexed(rng.choice(AGE_GROUPS, k, p=[0.05, 0.15, 0.8])) for k in participants],
+        "participant_gender": [_indexed(rng.choice(["Male", "Female"], k, p=[0.85, 0.15])) for k in participants],
+        "gun_type": [_indexed(rng.choice(GUN_TYPES, k)) if k else None for k in n_guns],
+        "gun_stolen": [_indexed(rng.choice(["Stolen", "Not-stolen", "Unknown"], k)) if k else None for k in n_guns],
+        "notes": rng.choice(["man shot in leg", "robbery at gas station", "domestic dispute", None], rows),
+        "incident_characteristics": [
+            "||".join(rng.choice(CHARACTERISTICS, k, replace=False)) if k else None for k in n_chars
+        ],
+    })
+
+    # Indicadors per estat i mes (i població per estat i any), repetits a cada incident
+    state_month = df[["state"]].assign(month=dates.to_period("M")).drop_duplicates()
+    m = len(state_month)
+    state_month["state_month_firearm_background_checks"] = rng.integers(1_000, 200_000, m)
+    state_month["state_month_employment_rate"] = rng.uniform(88, 97, m).round(1)
+    state_month["state_month_total_police_murders"] = rng.poisson(3, m)
+    state_month["state_month_police_murders_male_victims"] = rng.poisson(3, m)
+    state_month["state_month_police_murders_female_victims"] = rng.poisson(0.3, m)
+    population = dict(zip(STATES, rng.integers(500_000, 40_000_000, len(STATES))))
+    df = df.assign(month=dates.to_period("M")).merge(state_month, on=["state", "month"], how="left")
+    df["state_year_population"] = df["state"].map(population) * (1 + 0.01 * (dates.year.to_numpy() - 2013))
+    df["state_votes_democrats_2020"] = df["state"].map({s: rng.integers(100_000, 5_000_000) for s in STATES})
+    df["state_votes_republicans_2020"] = df["state"].map({s: rng.integers(100_000, 5_000_000) for s in STATES})
+    df.drop(columns="month").to_csv(path, index=False)
+
+
+def _rss_mb():
+    """RSS actual del procés en MB (Linux), o el màxim si /proc no existeix."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _session(app_path, data_dir, interactions, think_time, seed, barrier, queue, timeout):
+    """Una sessió simulada en el seu propi procés: execució inicial i `interactions` canvis de selectbox."""
+    rng = random.Random(seed)
+    metrics = {"first": np.nan, "reruns": [], "errors": [], "start": np.nan, "end": np.nan}
+    try:
+        os.chdir(data_dir)
+        # `streamlit run` afegeix el directori de l'script al sys.path; AppTest no
+        sys.path.insert(0, os.path.dirname(app_path))
+        from streamlit.testing.v1 import AppTest
+
+        at = AppTest.from_file(app_path, default_timeout=timeout)
+        start = time.perf_counter()
+        at.run()
+        metrics["first"] = time.perf_counter() - start
+        metrics["errors"].extend(e.message for e in at.exception)
+    except Exception as e:  # la sessió es compta com a error i la prova continua
+        metrics["errors"].append(repr(e))
+    # Totes les sessions comencen a interactuar alhora, un cop carregades; si alguna no hi arriba
+    # (ha petat o l'han matat), la barrera es trenca en exhaurir el temps i les altres no es queden penjades
+    try:
+        barrier.wait(timeout=timeout)
+    except threading.BrokenBarrierError:
+        metrics["errors"].append("barrera trencada: alguna sessió no ha acabat la càrrega inicial")
+    metrics["start"] = time.time()
+    try:
+        for _ in range(interactions if not metrics["errors"] else 0):
+            time.sleep(rng.expovariate(1 / think_time) if think_time > 0 else 0)
+            box = at.selectbox(key=rng.choice(WIDGETS))
+            box.set_value(rng.choice(box.options))
+            start = time.perf_counter()
+            at.run()
+            metrics["reruns"].append(time.perf_counter() - start)
+            metrics["errors"].extend(e.message for e in at.exception)
+    except Exception as e:
+        metrics["errors"].append(repr(e))
+    metrics["end"] = time.time()
+    metrics["rss_mb"] = _rss_mb()
+    metrics["rss_peak_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    queue.put(metrics)
+
+
+def _collect(procs, queue, deadline):
+    """Resultats de les sessions fins que tots hi són, tots els processos han acabat o s'arriba a `deadline`."""
+    results = []
+    while len(results) < len(procs) and time.monotonic() < deadline:
+        try:
+            results.append(queue.get(timeout=1))
+        except queue_module.Empty:
+            if all(proc.exitcode is not None for proc in procs):
+                break
+    # Un procés que ha acabat pot haver deixat el resultat a la cua just després de l'últim get
+    while len(results) < len(procs):
+        try:
+            results.append(queue.get_nowait())
+        except queue_module.Empty:
+            break
+    return results
+
+
+def run_level(app_path, data_dir, sessions, interactions, think_time, seed=0, timeout=1800):
+    """Executa `sessions` sessions concurrents i en resumeix latència, throughput i memòria.
+
+    La càrrega inicial i les interaccions tenen `timeout` segons cadascuna; les sessions que
+    moren o no acaben a temps es compten com a errors.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    barrier, queue = ctx.Barrier(sessions), ctx.Queue()
+    procs = [
+        ctx.Process(
+            target=_session, args=(app_path, data_dir, interactions, think_time, seed + i, barrier, queue, timeout)
+        )
+        for i in range(sessions)
+    ]
+    for proc in procs:
+        proc.start()
+    results = _collect(procs, queue, time.monotonic() + 2 * timeout)
+    for proc in procs:
+        proc.join(timeout=5)
+        if proc.is_alive():
+            proc.terminate()
+            proc.join()
+
+    reruns = np.array([r for res in results for r in res["reruns"]])
+    errors = [e for res in results for e in res["errors"]]
+    if len(results) < sessions:
+        exitcodes = [proc.exitcode for proc in procs]
+        errors.append(f"{sessions - len(results)} sessions sense resultat (exitcodes {exitcodes})")
+    wall = max(res["end"] for res in results) - min(res["start"] for res in results) if results else np.nan
+    percentiles = np.percentile(reruns, [50, 95, 99]) if len(reruns) else [np.nan] * 3
+    return {
+        "sessions": sessions,
+        "reruns": len(reruns),
+        "p50_s": percentiles[0],
+        "p95_s": percentiles[1],
+        "p99_s": percentiles[2],
+        "first_run_max_s": max((res["first"] for res in results if not np.isnan(res["first"])), default=np.nan),
+        "throughput_rps": len(reruns) / wall if wall > 0 else np.nan,
+        "rss_mean_mb": np.mean([res["rss_mb"] for res in results]) if results else np.nan,
+        "rss_peak_mb": max((res["rss_peak_mb"] for res in results), default=np.nan),
+        "errors": len(errors),
+        "first_error": errors[0] if errors else "",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", default="1,2,4,8", help="nivells de sessions concurrents, separats per comes")
+    parser.add_argument("--interactions", type=int, default=10, help="canvis de selectbox per sessió")
+    parser.add_argument("--think-time", type=float, default=1.0, help="temps de reflexió mitjà entre interaccions (s)")
+    parser.add_argument("--rows", type=int, default=50_000, help="incidents del dataset sintètic")
+    parser.add_argument("--data", help="final.csv real en lloc del sintètic")
+    parser.add_argument("--app", default=APP_PATH)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=1800, help="temps màxim de la càrrega inicial i de les interaccions de cada sessió (s)")
+    parser.add_argument("--csv", help="desa els resultats en aquest fitxer CSV")
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix="vdd_loadtest_")
+    try:
+        if args.data:
+            shutil.copy(args.data, os.path.join(data_dir, "final.csv"))
+        else:
+            make_synthetic_dataset(os.path.join(data_dir, "final.csv"), args.rows, args.seed)
+
+        results = []
+        for sessions in (int(c) for c in args.concurrency.split(",")):
+            result = run_level(
+                os.path.abspath(args.app), data_dir, sessions, args.interactions, args.think_time, args.seed,
+                args.timeout,
+            )
+            results.append(result)
+            print(
+                f"{sessions:>3} sessions: p50 {result['p50_s']:.3f}s  p95 {result['p95_s']:.3f}s  "
+                f"p99 {result['p99_s']:.3f}s  {result['throughput_rps']:.2f} reruns/s  "
+                f"RSS/procés {result['rss_mean_mb']:.0f} MB (pic {result['rss_peak_mb']:.0f} MB)  "
+                f"errors {result['errors']}",
+                flush=True,
+            )
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    table = pd.DataFrame(results)
+    print()
+    print(table.drop(columns="first_error").to_string(index=False, float_format="%.3f"))
+    if args.csv:
+        table.to_csv(args.csv, index=False)
+
+
+if __name__ == "__main__":
+    main()